@@ -0,0 +1,78 @@
+import asyncio
+from collections import deque
+from typing import Deque
+
+
+class Admission:
+    """Семафор с изменяемым лимитом: сжимается при 429 и постепенно восстанавливается"""
+
+    def __init__(self, limit: int, ramp_up_after: int = 20):
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._current = 0
+        self._max_limit = max(1, limit)
+        self._ramp_up_after = ramp_up_after
+        self._successes = 0
+        self.limit = self._max_limit
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *args):
+        self.release()
+
+    async def acquire(self):
+        if self._current < self.limit and not self._waiters:
+            self._current += 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut in self._waiters:
+                self._waiters.remove(fut)
+            # Слот уже был выдан, но задачу отменили до старта — возвращаем его следующему
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        # Без await: отмена задачи не может помешать вернуть слот
+        self._current -= 1
+        self._wake_up()
+
+    def _wake_up(self):
+        # Слот передаётся ожидающему сразу, поэтому пробуждение не теряется
+        while self._waiters and self._current < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._current += 1
+                fut.set_result(None)
+
+    def on_rate_limited(self) -> bool:
+        """Уменьшает лимит на единицу. Возвращает True, если лимит изменился"""
+        self._successes = 0
+        return self.resize(self.limit - 1)
+
+    def on_success(self) -> bool:
+        """После серии успешных запросов увеличивает лимит обратно до исходного"""
+        if self.limit >= self._max_limit:
+            return False
+
+        self._successes += 1
+        if self._successes < self._ramp_up_after:
+            return False
+
+        self._successes = 0
+        return self.resize(self.limit + 1)
+
+    def resize(self, limit: int) -> bool:
+        limit = min(max(1, limit), self._max_limit)
+        if limit == self.limit:
+            return False
+
+        self.limit = limit
+        self._wake_up()
+        return True
@@ -1,19 +1,61 @@
 import asyncio
-import aiohttp
+import httpx
+import aiofiles
+import orjson
 from pathlib import Path
-from typing import Optional, Dict, Any, List
+from urllib.parse import urlsplit
+from typing import Optional, Dict, Any, List, Set, Coroutine, Callable, Awaitable
 
 from config import Config
 from colors import Colors
+from admission import Admission
+
+
+# Одна сессия на весь процесс: keep-alive и TLS-соединения переиспользуются между клиентами
+_SHARED_SESSION: Optional[httpx.AsyncClient] = None
+
+
+def _get_shared_session(cfg: Config, headers: Dict[str, str]) -> httpx.AsyncClient:
+    global _SHARED_SESSION
+    if _SHARED_SESSION is None or _SHARED_SESSION.is_closed:
+        # HTTP/2 мультиплексирует параллельные запросы картинок в одном TLS-соединении
+        limits = httpx.Limits(
+            max_connections=cfg.max_concurrent_images * 4,
+            max_keepalive_connections=cfg.max_concurrent_images * 2,
+            keepalive_expiry=75
+        )
+        _SHARED_SESSION = httpx.AsyncClient(
+            http2=True,
+            headers=headers,
+            timeout=httpx.Timeout(30),
+            limits=limits,
+            follow_redirects=True
+        )
+    return _SHARED_SESSION
+
+
+async def close_shared_session():
+    global _SHARED_SESSION
+    if _SHARED_SESSION is not None and not _SHARED_SESSION.is_closed:
+        await _SHARED_SESSION.aclose()
+    _SHARED_SESSION = None
 
 
 class MangaAPIClient:
 
     def __init__(self, cfg: Config):
         self.cfg = cfg
-        self._session: Optional[aiohttp.ClientSession] = None
-        self._chapters_map: Dict[str, Dict[float, int | float]] = {}
-        self._series_cache: Dict[str, Dict[str, Any]] = {}
+        self._session: Optional[httpx.AsyncClient] = None
+        # Кэшируем не результат, а Future запроса: параллельные вызовы ждут один и тот же запрос
+        self._chapters_map: Dict[str, asyncio.Future] = {}
+        self._series_cache: Dict[str, asyncio.Future] = {}
+        self._volume_index: Dict[str, Dict[float, int]] = {}
+        self._background_tasks: Set[asyncio.Task] = set()
+        # Ограничение параллельных проб томов, чтобы не заваливать API запросами
+        self._probe_sem = asyncio.Semaphore(5)
+        # Лимиты глав и картинок (картинок — общий на все главы) подстраиваются под частоту 429
+        self.admission = Admission(cfg.max_concurrent_chapters)
+        self.image_admission = Admission(cfg.max_concurrent_images)
         self._headers = {
             "User-Agent": "Mozilla/5.0 (iPad; CPU OS 18_6_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) CriOS/142.0.7444.46 Mobile/15E148 Safari/604.1",
             "Accept": "*/*",
@@ -21,48 +63,64 @@ class MangaAPIClient:
         }
 
     async def __aenter__(self):
-        conn = aiohttp.TCPConnector(limit=self.cfg.max_concurrent_images * 2)
-        self._session = aiohttp.ClientSession(connector=conn, headers=self._headers)
-        await self._warm_up_session()
+        self._session = _get_shared_session(self.cfg, self._headers)
+        await asyncio.gather(self._warm_up_session(), self._warm_up_hosts())
         return self
 
     async def __aexit__(self, *args):
-        if self._session:
-            await self._session.close()
+        # Общая сессия закрывается через close_shared_session() в конце работы
+        pass
 
     async def _warm_up_session(self):
         try:
-            async with self._session.get(self.cfg.referer, timeout=6):
-                pass
+            await self._session.get(self.cfg.referer, timeout=6)
         except Exception:
             pass
 
+    async def _warm_up_hosts(self):
+        # httpx не кэширует DNS, поэтому заранее открываем keep-alive соединения
+        # к API и CDN: резолв и TLS-рукопожатие происходят один раз до начала загрузки
+        async def open_connection(base_url: str):
+            parts = urlsplit(base_url)
+            try:
+                await self._session.head(f"{parts.scheme}://{parts.netloc}/", timeout=6)
+            except Exception:
+                pass
+
+        await asyncio.gather(
+            open_connection(self.cfg.api_base),
+            open_connection(self.cfg.image_host)
+        )
+
     async def _get_json(self, url: str, params: Optional[Dict[str, Any]] = None, 
                        retries: int = 5) -> Dict[str, Any]:
         for attempt in range(retries):
             try:
-                async with self._session.get(url, params=params, timeout=30) as resp:
-                    if resp.status == 429:
-                        wait = self._calculate_retry_delay(resp.headers, attempt)
-                        print(Colors.warning(
-                            f"Rate limit (429). Retry in {wait:.2f}s... "
-                            f"(Attempt {attempt + 1}/{retries})"
-                        ))
-                        await asyncio.sleep(wait)
-                        continue
-
-                    resp.raise_for_status()
-                    data = await resp.json()
-                    await asyncio.sleep(self.cfg.request_delay)
-                    return data
-
-            except aiohttp.ClientResponseError as e:
-                if e.status == 429:
+                resp = await self._session.get(url, params=params, timeout=30)
+                if resp.status_code == 429:
+                    wait = self._calculate_retry_delay(resp.headers, attempt)
+                    print(Colors.warning(
+                        f"Rate limit (429). Retry in {wait:.2f}s... "
+                        f"(Attempt {attempt + 1}/{retries})"
+                    ))
+                    self._on_rate_limited()
+                    await asyncio.sleep(wait)
+                    continue
+
+                resp.raise_for_status()
+                data = orjson.loads(resp.content)
+                self._on_success()
+                await asyncio.sleep(self.cfg.request_delay)
+                return data
+
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code == 429:
                     wait = self._calculate_retry_delay({}, attempt)
                     print(Colors.warning(
                         f"Rate limit (429) via exception. Retry in {wait:.2f}s... "
                         f"(Attempt {attempt + 1}/{retries})"
                     ))
+                    self._on_rate_limited()
                     await asyncio.sleep(wait)
                     continue
                 if attempt == retries - 1:
@@ -77,6 +135,19 @@ class MangaAPIClient:
 
         raise RuntimeError("Retries exhausted")
 
+    def _on_rate_limited(self):
+        chapters_changed = self.admission.on_rate_limited()
+        images_changed = self.image_admission.on_rate_limited()
+        if chapters_changed or images_changed:
+            print(Colors.warning(
+                f"Too many 429 responses. Concurrency lowered to "
+                f"{self.admission.limit} chapters, {self.image_admission.limit} images"
+            ))
+
+    def _on_success(self):
+        self.admission.on_success()
+        self.image_admission.on_success()
+
     @staticmethod
     def _calculate_retry_delay(headers: Dict[str, str], attempt: int) -> float:
         retry_after = headers.get("Retry-After")
@@ -119,11 +190,27 @@ class MangaAPIClient:
         except Exception:
             return []
 
+    def _spawn(self, coro: Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    @staticmethod
+    async def _await_shared(fut: asyncio.Future):
+        # shield: отмена одного из ожидающих не должна отменять общий запрос
+        return await asyncio.shield(fut)
+
     # Потом попробую проверить данную функцию
     async def fetch_chapters_list(self, slug: str) -> Dict[float, int]:
-        if slug in self._chapters_map:
-            return self._chapters_map[slug]
-
+        fut = self._chapters_map.get(slug)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._chapters_map[slug] = fut
+            self._spawn(self._do_fetch_chapters_list(slug, fut))
+        return await self._await_shared(fut)
+
+    async def _do_fetch_chapters_list(self, slug: str, fut: asyncio.Future):
         url = f"{self.cfg.api_base}/{slug}/chapters"
         mapping: Dict[float, int] = {}
 
@@ -147,15 +234,26 @@ class MangaAPIClient:
                 if chapter_float is not None:
                     mapping[chapter_float] = volume_int
         except Exception:
+            # Не кэшируем неудачу: следующий вызов повторит запрос
+            self._chapters_map.pop(slug, None)
             mapping = {}
+        except asyncio.CancelledError:
+            self._chapters_map.pop(slug, None)
+            fut.cancel()
+            raise
 
-        self._chapters_map[slug] = mapping
-        return mapping
+        if not fut.done():
+            fut.set_result(mapping)
 
     async def fetch_series_info(self, slug: str) -> Dict[str, Any]:
-        if slug in self._series_cache:
-            return self._series_cache[slug]
-
+        fut = self._series_cache.get(slug)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._series_cache[slug] = fut
+            self._spawn(self._do_fetch_series_info(slug, fut))
+        return await self._await_shared(fut)
+
+    async def _do_fetch_series_info(self, slug: str, fut: asyncio.Future):
         url = f"{self.cfg.api_base}/{slug}"
         fields = [
             "background", "eng_name", "otherNames", "summary", "releaseDate", 
@@ -171,10 +269,15 @@ class MangaAPIClient:
             data = await self._get_json(url, params=params, retries=3)
             result = data.get("data", {}) if isinstance(data, dict) else {}
         except Exception:
+            self._series_cache.pop(slug, None)
             result = {}
+        except asyncio.CancelledError:
+            self._series_cache.pop(slug, None)
+            fut.cancel()
+            raise
 
-        self._series_cache[slug] = result
-        return result
+        if not fut.done():
+            fut.set_result(result)
 
     async def fetch_chapter_data(self, slug: str, chapter_num: int | float, 
                                  volume: int) -> Dict[str, Any]:
@@ -195,8 +298,8 @@ class MangaAPIClient:
         if chapters_map and target_chapter in chapters_map:
             return chapters_map[target_chapter]
 
-        series_info = await self.fetch_series_info(slug)
-        detected_volume = self._search_volume_in_metadata(series_info, target_chapter)
+        volume_index = await self._get_volume_index(slug)
+        detected_volume = volume_index.get(target_chapter)
         
         if detected_volume is not None:
             try:
@@ -207,88 +310,139 @@ class MangaAPIClient:
 
         return await self._bruteforce_volume(slug, chapter_num)
 
-    def _search_volume_in_metadata(self, metadata: Dict[str, Any], 
-                                   target_chapter: float) -> Optional[int]:
-        def search(obj) -> Optional[int]:
+    async def _get_volume_index(self, slug: str) -> Dict[float, int]:
+        if slug in self._volume_index:
+            return self._volume_index[slug]
+
+        series_info = await self.fetch_series_info(slug)
+        # Пока ждали ответ, индекс мог построить другой вызов
+        if slug not in self._volume_index:
+            index = self._build_volume_index(series_info)
+            # Пустой ответ не кэшируем, чтобы следующий вызов повторил запрос
+            if not series_info:
+                return index
+            self._volume_index[slug] = index
+        return self._volume_index[slug]
+
+    def _build_volume_index(self, metadata: Dict[str, Any]) -> Dict[float, int]:
+        # Один обход всего JSON вместо рекурсивного поиска для каждой главы
+        index: Dict[float, int] = {}
+        stack = [metadata]
+
+        while stack:
+            obj = stack.pop()
             if isinstance(obj, dict):
                 num = obj.get("number") or obj.get("chapter_number")
                 vol = obj.get("volume")
-                
+
                 if num is not None and vol is not None:
                     chapter_float = self._parse_float(str(num))
-                    if chapter_float == target_chapter:
+                    if chapter_float is not None and chapter_float not in index:
                         try:
-                            return int(vol)
+                            index[chapter_float] = int(vol)
                         except (ValueError, TypeError):
                             pass
-                
-                for value in obj.values():
-                    result = search(value)
-                    if result is not None:
-                        return result
+
+                stack.extend(reversed(list(obj.values())))
             elif isinstance(obj, list):
-                for item in obj:
-                    result = search(item)
-                    if result is not None:
-                        return result
-            return None
+                stack.extend(reversed(obj))
 
-        return search(metadata)
+        return index
 
     async def _bruteforce_volume(self, slug: str, chapter_num: int | float) -> int:
         start, end = self.cfg.fallback_volume_range
-        
-        for volume in range(start, end + 1):
-            try:
+
+        async def probe(volume: int) -> int:
+            async with self._probe_sem:
                 await asyncio.sleep(0.12)
                 await self.fetch_chapter_data(slug, chapter_num, volume)
                 return volume
-            except Exception:
-                continue
+
+        # Пробуем все тома параллельно и берём первый успешный ответ
+        tasks = [asyncio.create_task(probe(v)) for v in range(start, end + 1)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    return await next_done
+                except Exception:
+                    continue
+        finally:
+            for task in tasks:
+                task.cancel()
 
         raise ValueError(f"Could not determine volume for chapter {chapter_num}")
 
     async def download_image(self, url: str, dest: Path, retries: int = 10):
+        async def save(resp: httpx.Response):
+            # Пишем на диск по частям, не держа всё изображение в памяти
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            total = 0
+            try:
+                async with aiofiles.open(dest, "wb") as f:
+                    async for chunk in resp.aiter_bytes(64 * 1024):
+                        total += len(chunk)
+                        await f.write(chunk)
+            except BaseException:
+                dest.unlink(missing_ok=True)
+                raise
+
+            if total == 0:
+                dest.unlink(missing_ok=True)
+                raise RuntimeError("Empty response")
+
+        await self._fetch_image(url, save, retries)
+
+    async def fetch_image_bytes(self, url: str, retries: int = 10) -> bytes:
+        async def read(resp: httpx.Response) -> bytes:
+            data = await resp.aread()
+            if not data:
+                raise RuntimeError("Empty response")
+            return data
+
+        return await self._fetch_image(url, read, retries)
+
+    async def _fetch_image(self, url: str,
+                           consume: Callable[[httpx.Response], Awaitable[Any]],
+                           retries: int) -> Any:
         headers = {
             **self._headers,
             "Referer": self.cfg.referer,
             "Origin": self.cfg.referer.rstrip("/")
         }
 
-        for attempt in range(retries):
-            try:
-                async with self._session.get(url, headers=headers, timeout=60) as resp:
-                    if resp.status == 429:
-                        wait = self._calculate_retry_delay(resp.headers, attempt)
-                        print(Colors.warning(
-                            f"Rate limit (429) for image. Retry in {wait:.2f}s... "
-                            f"(Attempt {attempt + 1}/{retries})"
-                        ))
-                        await asyncio.sleep(wait)
-                        continue
-
-                    if resp.status == 403 and attempt < retries - 1:
-                        print(Colors.warning(
-                            f"403 Forbidden. Warming up and retrying... "
-                            f"(Attempt {attempt + 1}/{retries})"
-                        ))
-                        await self._warm_up_session()
-                        await asyncio.sleep(0.3 * (attempt + 1))
-                        continue
-
-                    resp.raise_for_status()
-                    data = await resp.read()
-                    
-                    if not data:
-                        raise RuntimeError("Empty response")
-
-                    dest.parent.mkdir(parents=True, exist_ok=True)
-                    dest.write_bytes(data)
-                    await asyncio.sleep(self.cfg.request_delay)
-                    return
+        async with self.image_admission:
+            for attempt in range(retries):
+                try:
+                    async with self._session.stream("GET", url, headers=headers, timeout=60) as resp:
+                        if resp.status_code == 429:
+                            wait = self._calculate_retry_delay(resp.headers, attempt)
+                            print(Colors.warning(
+                                f"Rate limit (429) for image. Retry in {wait:.2f}s... "
+                                f"(Attempt {attempt + 1}/{retries})"
+                            ))
+                            self._on_rate_limited()
+                            await asyncio.sleep(wait)
+                            continue
+
+                        if resp.status_code == 403 and attempt < retries - 1:
+                            print(Colors.warning(
+                                f"403 Forbidden. Warming up and retrying... "
+                                f"(Attempt {attempt + 1}/{retries})"
+                            ))
+                            await self._warm_up_session()
+                            await asyncio.sleep(0.3 * (attempt + 1))
+                            continue
+
+                        resp.raise_for_status()
+                        result = await consume(resp)
+                        self._on_success()
+                        await asyncio.sleep(self.cfg.request_delay)
+                        return result
 
-            except Exception as e:
-                if attempt == retries - 1:
-                    print(Colors.error(f"Image download failed after {retries} attempts: {e}"))
-                    raise
-                await asyncio.sleep(0.2 * (attempt + 1))
+                except Exception as e:
+                    if attempt == retries - 1:
+                        print(Colors.error(f"Image download failed after {retries} attempts: {e}"))
+                        raise
+                    await asyncio.sleep(0.2 * (attempt + 1))
+
+            raise RuntimeError("Retries exhausted")
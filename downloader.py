@@ -1,11 +1,12 @@
 import asyncio
-import json
+import os
 import time
 import re
 import shutil
 import zipfile
+import orjson
 from pathlib import Path
-from typing import Optional, Tuple, List
+from typing import Optional, Tuple, List, Dict, Awaitable
 from collections import defaultdict
 from tqdm.asyncio import tqdm as async_tqdm
 
@@ -16,47 +17,68 @@ from api_client import MangaAPIClient
 from metadata import MetadataGenerator
 
 
+_SANITIZE_RE = re.compile(r'[\\/*?:"<>|]')
+
+
+# Функции вызываются на каждую страницу/файл, поэтому вынесены из класса на уровень модуля
+def _sanitize_filename(text: str) -> str:
+    return _SANITIZE_RE.sub('_', text.strip())[:200]
+
+
+def _build_image_url(path: str, host: str, _http=("http://", "https://")) -> str:
+    if not path:
+        raise ValueError("Empty image path")
+
+    if path.startswith("//"):
+        path = path[1:]
+
+    if path.startswith(_http):
+        return path
+
+    return host + ("" if path[:1] == "/" else "/") + path
+
+
 class ChapterDownloader:
+    _PARENS_WITH_DIGITS_RE = re.compile(r'\s*\([^)]*\d[^)]*\)')
+    _DIGITS_RE = re.compile(r'\d+')
+
     def __init__(self, cfg: Config):
         self.cfg = cfg
-        self.metadata_gen = MetadataGenerator(cfg)
+        run_time = time.localtime()
+        self._run_ts = time.strftime("%Y-%m-%d %H:%M:%S", run_time)
+        # Одинаковая дата у всех записей CBZ делает архивы воспроизводимыми
+        self._run_ts_tuple = run_time[:6]
+        self.metadata_gen = MetadataGenerator(cfg, self._run_ts)
         self.cfg.output_dir.mkdir(parents=True, exist_ok=True)
 
-    @staticmethod
-    def sanitize_filename(text: str) -> str:
-        text = text.strip()
-        text = re.sub(r'[\\/*?:"<>|]', '_', text)
-        return text[:200]
-
-    @staticmethod
-    def build_image_url(path: str, host: str) -> str:
-        if not path:
-            raise ValueError("Empty image path")
-        
-        if path.startswith("//"):
-            path = path[1:]
-        
-        if path.startswith("http"):
-            return path
-        
-        if not path.startswith("/"):
-            path = "/" + path
-        
-        return host + path
-
-    @staticmethod
-    def clean_chapter_name(name: str) -> str:
-        name = re.sub(r'\s*\([^)]*\d[^)]*\)', '', name).strip()
-        name = re.sub(r'\d+', '', name).strip()
+    @classmethod
+    def clean_chapter_name(cls, name: str) -> str:
+        name = cls._PARENS_WITH_DIGITS_RE.sub('', name).strip()
+        name = cls._DIGITS_RE.sub('', name).strip()
         return name
 
     # Пока что пробую совместить номера обычных глав и экстр
-    async def download_chapter(self, api: MangaAPIClient, chapter_num: int | float) -> Optional[Tuple[Path, ChapterInfo]]:
-        tmp_dir = self.cfg.output_dir / f"_tmp_ch{chapter_num}_{int(time.time())}"
-        tmp_dir.mkdir(parents=True, exist_ok=True)
+    async def download_chapter(self, api: MangaAPIClient, chapter_num: int | float,
+                               volume: Optional[int] = None,
+                               check_finished: bool = True) -> Optional[Tuple[Path, ChapterInfo]]:
+        if self.cfg.cleanup_temp:
+            # Страницы пишутся сразу в CBZ, без промежуточной папки
+            tmp_path = self._staged_cbz_path(chapter_num)
+            part_path = tmp_path.with_name(tmp_path.name + ".part")
+
+            # Вызывающий код может уже проверить готовые главы сам
+            if check_finished:
+                finished = await self._find_finished_chapter(chapter_num)
+                if finished is not None:
+                    return finished
+        else:
+            tmp_path = self.cfg.output_dir / f"_tmp_ch{chapter_num}_{int(time.time())}"
+            part_path = tmp_path
+            tmp_path.mkdir(parents=True, exist_ok=True)
 
         try:
-            volume = await api.resolve_volume(self.cfg.manga_slug, chapter_num)
+            if volume is None:
+                volume = await api.resolve_volume(self.cfg.manga_slug, chapter_num)
             
             chapter_json = await api.fetch_chapter_data(
                 self.cfg.manga_slug, chapter_num, volume
@@ -84,7 +106,7 @@ class ChapterDownloader:
             print(f"  Volume: {volume} | Pages: {len(pages)} | Name: {chapter_name or 'N/A'}")
 
             urls = [
-                self.build_image_url(
+                _build_image_url(
                     p.get("url") or p.get("image", ""), 
                     self.cfg.image_host
                 )
@@ -95,8 +117,6 @@ class ChapterDownloader:
             if not urls:
                 raise ValueError("No valid image URLs found")
 
-            await self._download_images(api, urls, tmp_dir, chapter_num)
-
             info = ChapterInfo(
                 number=chapter_num,
                 volume=volume,
@@ -107,14 +127,75 @@ class ChapterDownloader:
                 chapter_id=str(data.get("id", ""))
             )
 
-            return tmp_dir, info
+            if self.cfg.cleanup_temp:
+                with zipfile.ZipFile(part_path, "w", zipfile.ZIP_STORED) as zf:
+                    await self._download_images_to_cbz(api, urls, zf, chapter_num)
+                    self._write_cbz_metadata(zf, info)
+                # Готовый CBZ появляется только после полной загрузки главы
+                os.replace(part_path, tmp_path)
+            else:
+                await self._download_images(api, urls, tmp_path, chapter_num)
+
+            return tmp_path, info
 
         except Exception as e:
             print(Colors.error(f"Chapter {chapter_num}: {e}"))
-            if tmp_dir.exists():
-                shutil.rmtree(tmp_dir, ignore_errors=True)
+            await asyncio.to_thread(self._remove_tmp, part_path)
+            return None
+
+    def _staged_cbz_path(self, chapter_num: int | float) -> Path:
+        # Имя без метки времени, чтобы повторный запуск нашёл уже готовую главу
+        slug = _sanitize_filename(self.cfg.manga_slug)
+        return self.cfg.output_dir / f"_tmp_{slug}_ch{chapter_num}.cbz"
+
+    async def _find_finished_chapter(self, chapter_num: int | float) -> Optional[Tuple[Path, ChapterInfo]]:
+        if not self.cfg.cleanup_temp:
+            return None
+
+        cbz_path = self._staged_cbz_path(chapter_num)
+        info = await asyncio.to_thread(self._load_finished_chapter, cbz_path, chapter_num)
+        if info is None:
+            return None
+
+        print(Colors.info(f"Skip Chapter {chapter_num}: already downloaded"))
+        return cbz_path, info
+
+    @staticmethod
+    def _load_finished_chapter(cbz_path: Path, chapter_num: int | float) -> Optional[ChapterInfo]:
+        if not cbz_path.is_file():
             return None
 
+        try:
+            with zipfile.ZipFile(cbz_path) as zf:
+                meta = orjson.loads(zf.read("info.txt"))
+                pages = [
+                    name for name in zf.namelist()
+                    if name not in ("info.txt", "ComicInfo.xml")
+                ]
+        except (zipfile.BadZipFile, KeyError, orjson.JSONDecodeError, OSError):
+            return None
+
+        # Архив с неполным набором страниц скачиваем заново
+        if not isinstance(meta, dict) or meta.get("pages") != len(pages):
+            return None
+
+        return ChapterInfo(
+            number=chapter_num,
+            volume=meta.get("volume"),
+            name=meta.get("chapter_name") or "",
+            pages_count=len(pages),
+            series_title=meta.get("series"),
+            teams=meta.get("teams") or [],
+            chapter_id=meta.get("chapter_id")
+        )
+
+    @staticmethod
+    def _remove_tmp(tmp_path: Path):
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        else:
+            tmp_path.unlink(missing_ok=True)
+
     async def _get_series_title(self, api: MangaAPIClient, chapter_data: dict) -> str:
         if self.cfg.series_title_override:
             return self.cfg.series_title_override
@@ -124,24 +205,80 @@ class ChapterDownloader:
                     chapter_data.get("manga_id") or "Unknown")
         return str(raw_title).strip()
 
+    @staticmethod
+    def _page_filenames(urls: List[str]) -> List[str]:
+        filenames = []
+        for idx, url in enumerate(urls, 1):
+            # То же, что Path(url).suffix, но без создания Path на каждую страницу
+            stem, dot, ext = url.rpartition("/")[2].rpartition(".")
+            filenames.append(f"{idx:03d}.{ext}" if dot and stem and ext else f"{idx:03d}.jpg")
+        return filenames
+
     async def _download_images(self, api: MangaAPIClient, urls: List[str], 
                                tmp_dir: Path, chapter_num: int | float):
-        sem = asyncio.Semaphore(self.cfg.max_concurrent_images)
+        filenames = self._page_filenames(urls)
+        await self._run_page_tasks(
+            [api.download_image(url, tmp_dir / fn) for url, fn in zip(urls, filenames)],
+            chapter_num
+        )
+
+    async def _download_images_to_cbz(self, api: MangaAPIClient, urls: List[str],
+                                      zf: zipfile.ZipFile, chapter_num: int | float):
+        filenames = self._page_filenames(urls)
+        # Страницы пишутся в архив строго по порядку: готовые, но «забежавшие вперёд»
+        # держим в памяти, пока не будут записаны все предыдущие
+        ready: Dict[int, bytes] = {}
+        next_idx = 0
 
         async def download_task(idx: int, url: str):
-            async with sem:
-                ext = Path(url).suffix or ".jpg"
-                filename = f"{idx:03d}{ext}"
-                await api.download_image(url, tmp_dir / filename)
-
-        tasks = [download_task(i + 1, url) for i, url in enumerate(urls)]
-        await async_tqdm.gather(
-            *tasks, 
-            desc=f"  Downloading Ch{chapter_num}", 
-            unit="img"
+            nonlocal next_idx
+            ready[idx] = await api.fetch_image_bytes(url)
+            # writestr синхронный и между ним и await нет переключений, так что лок не нужен
+            while next_idx in ready:
+                zf.writestr(self._zip_info(filenames[next_idx]), ready.pop(next_idx))
+                next_idx += 1
+
+        await self._run_page_tasks(
+            [download_task(idx, url) for idx, url in enumerate(urls)],
+            chapter_num
         )
 
-    def create_cbz(self, tmp_dir: Path, info: ChapterInfo, cbz_path: Path):
+    async def _run_page_tasks(self, coros: List[Awaitable], chapter_num: int | float):
+        tasks = [asyncio.create_task(coro) for coro in coros]
+        try:
+            with async_tqdm(total=len(tasks), desc=f"  Downloading Ch{chapter_num}", unit="img") as pbar:
+                for next_done in asyncio.as_completed(tasks):
+                    await next_done
+                    pbar.update(1)
+        finally:
+            # Если страница упала, остальные задачи отменяем и дожидаемся до закрытия архива
+            # или удаления папки: иначе они держат слот image_admission и пишут в уже закрытый ZipFile
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def create_cbz(self, tmp_path: Path, info: ChapterInfo, cbz_path: Path):
+        # Глава уже собрана в CBZ при скачивании — достаточно положить файл на место.
+        # Копируем, а не перемещаем: при неудачных главах staged-файлы нужны для повторного запуска
+        if tmp_path.is_file():
+            try:
+                os.link(tmp_path, cbz_path)
+            except OSError:
+                shutil.copyfile(tmp_path, cbz_path)
+            return
+
+        # Страницы уже сжаты (JPEG/PNG/WebP), поэтому складываем их без компрессии
+        with zipfile.ZipFile(cbz_path, "w", zipfile.ZIP_STORED) as zf:
+            self._write_cbz_metadata(zf, info)
+            
+            # scandir отдаёт тип файла без лишнего stat на каждую страницу
+            with os.scandir(tmp_path) as it:
+                entries = sorted((e for e in it if e.is_file()), key=lambda e: e.name)
+            for entry in entries:
+                with open(entry.path, "rb") as src, zf.open(self._zip_info(entry.name), "w") as dst:
+                    shutil.copyfileobj(src, dst)
+
+    def _write_cbz_metadata(self, zf: zipfile.ZipFile, info: ChapterInfo):
         final_series_title = info.series_title or self.cfg.manga_slug
 
         meta = {
@@ -152,18 +289,22 @@ class ChapterDownloader:
             "chapter_id": info.chapter_id,
             "teams": info.teams,
             "pages": info.pages_count,
-            "created_at": time.strftime("%Y-%m-%d %H:%M:%S")
+            "created_at": self._run_ts
         }
 
         comicinfo_xml = self.metadata_gen.create_chapter_comicinfo(info)
 
-        with zipfile.ZipFile(cbz_path, "w", zipfile.ZIP_DEFLATED) as zf:
-            zf.writestr("info.txt", json.dumps(meta, ensure_ascii=False, indent=2))
-            zf.writestr("ComicInfo.xml", comicinfo_xml)
-            
-            for file in sorted(tmp_dir.iterdir()):
-                if file.is_file():
-                    zf.write(file, arcname=file.name)
+        zf.writestr(
+            self._zip_info("info.txt"),
+            orjson.dumps(meta, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        )
+        zf.writestr(self._zip_info("ComicInfo.xml"), comicinfo_xml)
+
+    def _zip_info(self, name: str) -> zipfile.ZipInfo:
+        zi = zipfile.ZipInfo(name, date_time=self._run_ts_tuple)
+        zi.compress_type = zipfile.ZIP_STORED
+        zi.external_attr = 0o644 << 16
+        return zi
 
 
     # Не получилось, но надо сделать проверку на экстру
@@ -195,7 +336,8 @@ class ChapterDownloader:
             return []
 
         zip_path = await self._create_series_archive(
-            successful, series_title, series_meta, api
+            successful, series_title, series_meta, api,
+            keep_staged=len(successful) < len(chapters)
         )
 
         self._print_summary(len(successful), len(chapters), failed_count)
@@ -220,16 +362,46 @@ class ChapterDownloader:
                 self.cfg.manga_slug)
 
     async def _download_all_chapters(self, api: MangaAPIClient, chapters: List[int | float]) -> list:
-        sem = asyncio.Semaphore(self.cfg.max_concurrent_chapters)
-
-        async def download_with_limit(ch: int | float):
-            async with sem:
-                return await self.download_chapter(api, ch)
-
-        return await asyncio.gather(
-            *[download_with_limit(ch) for ch in chapters],
+        # Уже скачанные главы отбираем до любых запросов к API
+        finished = await asyncio.gather(*[self._find_finished_chapter(ch) for ch in chapters])
+        to_download = [ch for ch, done in zip(chapters, finished) if done is None]
+
+        # Тома определяем заранее одним пакетом, чтобы главы не ждали проб друг за другом.
+        # Параллельность ограничена тем же лимитом глав, чтобы не устроить шквал запросов к API
+        async def resolve_with_limit(ch: int | float) -> int:
+            async with api.admission:
+                return await api.resolve_volume(self.cfg.manga_slug, ch)
+
+        resolved = await asyncio.gather(
+            *[resolve_with_limit(ch) for ch in to_download],
             return_exceptions=True
         )
+        volumes = dict(zip(to_download, resolved))
+
+        async def download_with_limit(idx: int, ch: int | float):
+            if finished[idx] is not None:
+                return idx, finished[idx]
+            volume = volumes[ch]
+            if isinstance(volume, Exception):
+                return idx, volume
+            try:
+                async with api.admission:
+                    return idx, await self.download_chapter(api, ch, volume, check_finished=False)
+            except Exception as e:
+                return idx, e
+
+        # Обрабатываем главы по мере готовности, а не ждём завершения всех сразу
+        results: list = [None] * len(chapters)
+        completed = 0
+        pending = [download_with_limit(idx, ch) for idx, ch in enumerate(chapters)]
+        for next_done in asyncio.as_completed(pending):
+            idx, result = await next_done
+            results[idx] = result
+            if result and not isinstance(result, Exception):
+                completed += 1
+                print(Colors.success(f"Progress: {completed}/{len(chapters)} chapters"))
+
+        return results
 
     def _process_results(self, chapters: List[int | float], 
                         results: list) -> Tuple[list, int]:
@@ -245,7 +417,8 @@ class ChapterDownloader:
         
         return successful, failed_count
 
-    async def _create_series_archive(self, successful: list, series_title: str, series_meta: dict, api: MangaAPIClient) -> Path:
+    async def _create_series_archive(self, successful: list, series_title: str, series_meta: dict,
+                                     api: MangaAPIClient, keep_staged: bool = False) -> Path:
         volume_groups = defaultdict(list)
         for tmp_dir, info in successful:
             volume_groups[info.volume].append((tmp_dir, info))
@@ -253,7 +426,7 @@ class ChapterDownloader:
         temp_series_dir = self.cfg.output_dir / f"_tmp_series_{int(time.time())}"
         temp_series_dir.mkdir(parents=True, exist_ok=True)
 
-        sanitized_series = self.sanitize_filename(series_title)
+        sanitized_series = _sanitize_filename(series_title)
         series_folder = temp_series_dir / sanitized_series
         series_folder.mkdir(exist_ok=True)
 
@@ -261,11 +434,16 @@ class ChapterDownloader:
 
         self._create_series_metadata(series_folder, series_title, series_meta)
 
-        self._process_volumes(volume_groups, series_folder, series_title, series_meta)
+        # Упаковка и удаление файлов блокируют поток, поэтому выносим их из event loop
+        await asyncio.to_thread(
+            self._process_volumes, volume_groups, series_folder, series_title, series_meta
+        )
 
-        zip_path = self._create_final_archive(temp_series_dir, sanitized_series)
+        zip_path = await asyncio.to_thread(
+            self._create_final_archive, temp_series_dir, sanitized_series
+        )
 
-        self._cleanup(successful, temp_series_dir)
+        await asyncio.to_thread(self._cleanup, successful, temp_series_dir, keep_staged)
 
         return zip_path
 
@@ -305,7 +483,7 @@ class ChapterDownloader:
                 chapter_list = sorted(volume_groups[volume], key=lambda x: x[1].number)
                 
                 vol_name = f"Volume {volume:02d}"
-                sanitized_vol = self.sanitize_filename(vol_name)
+                sanitized_vol = _sanitize_filename(vol_name)
                 vol_folder = series_folder / sanitized_vol
                 vol_folder.mkdir(exist_ok=True)
 
@@ -321,7 +499,7 @@ class ChapterDownloader:
                         chap_name = f"Chapter {info.number:.1f}"
                     else:
                         chap_name = f"Chapter {info.number}"
-                    sanitized_chap = self.sanitize_filename(chap_name)
+                    sanitized_chap = _sanitize_filename(chap_name)
                     cbz_path = vol_folder / f"{sanitized_chap}.cbz"
                     self.create_cbz(tmp_dir, info, cbz_path)
         else:
@@ -338,7 +516,7 @@ class ChapterDownloader:
                 else:
                     chap_name = f"Chapter {info.number}"
 
-                sanitized_chap = self.sanitize_filename(chap_name)
+                sanitized_chap = _sanitize_filename(chap_name)
                 cbz_path = series_folder / f"{sanitized_chap}.cbz"
                 self.create_cbz(tmp_dir, info, cbz_path)
 
@@ -349,13 +527,17 @@ class ChapterDownloader:
         print(Colors.success(f"Saved archive: {zip_path.name}"))
         return zip_path
 
-    def _cleanup(self, successful: list, temp_series_dir: Path):
+    def _cleanup(self, successful: list, temp_series_dir: Path, keep_staged: bool = False):
         if not self.cfg.cleanup_temp:
             return
 
-        for tmp_dir, _ in successful:
-            if tmp_dir.exists():
-                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if keep_staged:
+            # Часть глав не скачалась: готовые главы оставляем, чтобы повторный запуск их пропустил
+            print(Colors.info("Some chapters failed: keeping downloaded chapters for the next run"))
+        else:
+            for tmp_path, _ in successful:
+                if tmp_path.exists():
+                    self._remove_tmp(tmp_path)
         
         if temp_series_dir.exists():
             shutil.rmtree(temp_series_dir, ignore_errors=True)
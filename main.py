@@ -1,7 +1,6 @@
 import asyncio
 from pathlib import Path
 from config import Config
-from downloader import ChapterDownloader
 
 
 def prompt_user_config() -> Config:
@@ -47,8 +46,16 @@ def prompt_user_config() -> Config:
 
 async def main():
     cfg = prompt_user_config()
+
+    # Тяжёлые зависимости (httpx, tqdm, orjson) грузим уже после ввода, чтобы вопросы появлялись сразу
+    from downloader import ChapterDownloader
+    from api_client import close_shared_session
+
     downloader = ChapterDownloader(cfg)
-    await downloader.download_chapters(cfg.chapter_range)
+    try:
+        await downloader.download_chapters(cfg.chapter_range)
+    finally:
+        await close_shared_session()
 
 
 if __name__ == "__main__":
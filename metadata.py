@@ -1,38 +1,56 @@
+import html
 import time
-import json
+import orjson
 import re
 import xml.etree.ElementTree as ET
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from models import ChapterInfo
 from config import Config
 
 
+_NOTES_PREFIX = "Generated by MangaLib Downloader v2.0 at "
+
+# ComicInfo главы собирается по шаблону: вывод тот же, что у ET.tostring, но без дерева элементов
+_CHAPTER_XML_TEMPLATE = (
+    "<?xml version='1.0' encoding='utf-8'?>\n"
+    "<ComicInfo>"
+    "<Title>{title}</Title>"
+    "<Series>{series}</Series>"
+    "<Number>{number}</Number>"
+    "<Volume>{volume}</Volume>"
+    "<PageCount>{pages}</PageCount>"
+    "<Summary>{summary}</Summary>"
+    "{writer}"
+    "<Notes>{notes}</Notes>"
+    "</ComicInfo>"
+)
+
+
 class MetadataGenerator:
-    def __init__(self, cfg: Config):
+    def __init__(self, cfg: Config, run_ts: Optional[str] = None):
         self.cfg = cfg
+        # Одна метка времени на весь запуск: одинаковая во всех файлах пакета
+        self.run_ts = run_ts or time.strftime("%Y-%m-%d %H:%M:%S")
+        self._notes = _NOTES_PREFIX + self.run_ts
 
     def create_chapter_comicinfo(self, info: ChapterInfo) -> bytes:
-        root = ET.Element("ComicInfo")
-        
-        ET.SubElement(root, "Title").text = info.name or f"Chapter {info.number}"
-        ET.SubElement(root, "Series").text = info.series_title or self.cfg.manga_slug
-        ET.SubElement(root, "Number").text = str(info.number)
-        ET.SubElement(root, "Volume").text = str(info.volume)
-        ET.SubElement(root, "PageCount").text = str(info.pages_count)
-        ET.SubElement(root, "Summary").text = (
-            f"Chapter {info.number} of {info.series_title or self.cfg.manga_slug}"
-        )
-        
-        if info.teams:
-            ET.SubElement(root, "Writer").text = ", ".join(info.teams)
-        
-        ET.SubElement(root, "Notes").text = (
-            f"Generated by MangaLib Downloader v2.0 at "
-            f"{time.strftime('%Y-%m-%d %H:%M:%S')}"
-        )
+        def esc(value) -> str:
+            return html.escape(str(value), quote=False)
 
-        return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+        series = info.series_title or self.cfg.manga_slug
+        writer = f"<Writer>{esc(', '.join(info.teams))}</Writer>" if info.teams else ""
+
+        return _CHAPTER_XML_TEMPLATE.format(
+            title=esc(info.name or f"Chapter {info.number}"),
+            series=esc(series),
+            number=esc(info.number),
+            volume=esc(info.volume),
+            pages=esc(info.pages_count),
+            summary=esc(f"Chapter {info.number} of {series}"),
+            writer=writer,
+            notes=esc(self._notes)
+        ).encode("utf-8")
 
     def create_series_comicinfo(self, series_title: str, series_info: Dict[str, Any]) -> bytes:
         root = ET.Element("ComicInfo")
@@ -69,10 +87,7 @@ class MetadataGenerator:
         if country:
             ET.SubElement(root, "Country").text = country
         
-        ET.SubElement(root, "Notes").text = (
-            f"Generated by MangaLib Downloader v2.0 at "
-            f"{time.strftime('%Y-%m-%d %H:%M:%S')}"
-        )
+        ET.SubElement(root, "Notes").text = self._notes
         
         return ET.tostring(root, encoding="utf-8", xml_declaration=True)
 
@@ -102,10 +117,7 @@ class MetadataGenerator:
         if language:
             ET.SubElement(root, "LanguageISO").text = language
         
-        ET.SubElement(root, "Notes").text = (
-            f"Generated by MangaLib Downloader v2.0 at "
-            f"{time.strftime('%Y-%m-%d %H:%M:%S')}"
-        )
+        ET.SubElement(root, "Notes").text = self._notes
         
         return ET.tostring(root, encoding="utf-8", xml_declaration=True)
 
@@ -198,7 +210,7 @@ class MetadataGenerator:
             "authors": authors_list
         }
 
-        return json.dumps(series_dict, ensure_ascii=False, indent=2)
+        return orjson.dumps(series_dict, option=orjson.OPT_INDENT_2).decode("utf-8")
 
     def _extract_authors(self, series_info: Dict[str, Any]) -> List[Dict[str, str]]:
         authors_list = []